@@ -0,0 +1 @@
+# intentionally empty, pytest puts the directory of a conftest.py on sys.path so tests can import mteb_zh
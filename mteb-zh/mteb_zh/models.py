@@ -1,8 +1,9 @@
 from enum import Enum
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 from itertools import islice
-from typing import Any, Generator, Iterable, Optional, Protocol, TypeVar, cast
+from typing import Any, Callable, Generator, Iterable, Mapping, Optional, Protocol, TypeVar, cast
 
 import torch
 import numpy as np
@@ -12,6 +13,8 @@ from sentence_transformers import SentenceTransformer
 
 
 T = TypeVar('T')
+# bert-family models whose constructor accepts `add_pooling_layer`
+POOLER_MODEL_TYPES = {'bert', 'megatron-bert', 'roberta', 'xlm-roberta', 'camembert', 'ernie', 'nezha'}
 
 
 class MTEBModel(Protocol):
@@ -65,75 +68,311 @@ def load_model(model_type: ModelType, model_name: str | None = None) -> MTEBMode
             raise ValueError(f'Unknown model type: {model_type}')
 
 
+def to_bettertransformer(model: torch.nn.Module) -> torch.nn.Module | None:
+    try:
+        from optimum.bettertransformer import BetterTransformer
+    except ImportError:
+        return None
+    try:
+        return BetterTransformer.transform(model)
+    except (NotImplementedError, ValueError):
+        return None
+
+
+def prepare_encoder(
+    model: torch.nn.Module, device: str, compile_model: bool = True, use_bettertransformer: bool = True
+) -> tuple[torch.nn.Module, int, int | None]:
+    """Move the model to `device` and apply the inference speedups available there.
+
+    Returns the prepared model, the number of gpus batches are sharded over and the multiple that padded
+    lengths should be rounded up to.
+    """
+    model.to(device)
+    # weights are cast directly instead of running under autocast, which disables the BetterTransformer fast path
+    if device.startswith('cuda'):
+        model.half()
+    # fused encoder layers that skip padded tokens, torch.compile is only used when they are unavailable
+    bettertransformer_model = to_bettertransformer(model) if use_bettertransformer else None
+    if bettertransformer_model is not None:
+        model = bettertransformer_model
+        compile_model = False
+    # shard batches over all visible gpus, cuda graphs of the compiled model don't mix with DataParallel
+    num_devices = torch.cuda.device_count() if device == 'cuda' else 1
+    # padded lengths are rounded up so the compiled model only sees a few distinct shapes
+    pad_to_multiple_of = None
+    if num_devices > 1:
+        model = torch.nn.DataParallel(model)
+    elif compile_model and device.startswith('cuda'):
+        model = torch.compile(model, mode='reduce-overhead')
+        pad_to_multiple_of = 64
+    return model, num_devices, pad_to_multiple_of
+
+
 def generate_batch(data: Iterable[T], batch_size: int = 32) -> Generator[list[T], None, None]:
     iterator = iter(data)
     while batch := list(islice(iterator, batch_size)):
         yield batch
 
 
+def generate_text_batch(
+    texts: Iterable[str], batch_size: int = 32, max_length: int = 2000, length_function: Callable[[str], int] = len
+) -> Generator[list[str], None, None]:
+    batch: list[str] = []
+    batch_length = 0
+    for text in texts:
+        text_length = length_function(text)
+        if batch and (len(batch) >= batch_size or batch_length + text_length > max_length):
+            yield batch
+            batch = []
+            batch_length = 0
+        batch.append(text)
+        batch_length += text_length
+    if batch:
+        yield batch
+
+
+def create_token_counter(model_name: str) -> Callable[[str], int]:
+    try:
+        import tiktoken
+
+        encoding = tiktoken.encoding_for_model(model_name)
+    except (ImportError, KeyError):
+        # conservative estimate for Chinese text, which is usually more than one token per character
+        return lambda text: 2 * len(text)
+    # special-token strings are ordinary corpus text here, the count only guides packing
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+class EmbeddingCollector:
+    """Gather batch embeddings into one (N, D) array, scattered back through `order`.
+
+    CUDA tensors are copied into pinned host buffers on a side stream, so the copy of one batch
+    overlaps with the forward pass of the next.
+    """
+
+    def __init__(self, order: np.ndarray) -> None:
+        self.order = order
+        self.offset = 0
+        self.embeddings = np.empty((len(order), 0), dtype=np.float32)
+        self._copy_stream: torch.cuda.Stream | None = None
+        self._host_buffers: list[torch.Tensor] = []
+        self._num_copies = 0
+        self._pending: tuple[torch.Tensor, torch.cuda.Event, np.ndarray] | None = None
+
+    def add(self, embeddings: torch.Tensor) -> None:
+        embeddings = embeddings.float()
+        if self.offset == 0:
+            self.embeddings = np.empty((len(self.order), embeddings.shape[-1]), dtype=np.float32)
+        indices = self.order[self.offset : self.offset + len(embeddings)]
+        self.offset += len(embeddings)
+
+        if not embeddings.is_cuda:
+            self.embeddings[indices] = embeddings.cpu().numpy()
+            return
+
+        if self._copy_stream is None:
+            self._copy_stream = torch.cuda.Stream(device=embeddings.device)
+            # the first batch is the largest one, so its shape bounds every later batch
+            self._host_buffers = [torch.empty(embeddings.shape, dtype=torch.float32, pin_memory=True) for _ in range(2)]
+        host_buffer = self._host_buffers[self._num_copies % 2][: len(embeddings)]
+        self._num_copies += 1
+
+        self._copy_stream.wait_stream(torch.cuda.current_stream(embeddings.device))
+        with torch.cuda.stream(self._copy_stream):
+            host_buffer.copy_(embeddings, non_blocking=True)
+            copy_done = torch.cuda.Event()
+            copy_done.record()
+        embeddings.record_stream(self._copy_stream)
+
+        self._flush()
+        self._pending = (host_buffer, copy_done, indices)
+
+    def _flush(self) -> None:
+        if self._pending is None:
+            return
+        host_buffer, copy_done, indices = self._pending
+        copy_done.synchronize()
+        self.embeddings[indices] = host_buffer.numpy()
+        self._pending = None
+
+    def finish(self) -> np.ndarray:
+        self._flush()
+        return self.embeddings
+
+
+class DeviceInputBuffers:
+    """Copy tokenizer outputs into device buffers that are kept across batches and encode calls.
+
+    Batches change shape all the time, so each input is a contiguous view of a flat buffer that only grows.
+    Inputs are staged in pinned host buffers that grow the same way, so no batch pays for pinning memory.
+    """
+
+    def __init__(self, device: str) -> None:
+        self.device = device
+        self._buffers: dict[str, tuple[torch.Tensor, torch.Tensor]] = {}
+        self._copy_done: torch.cuda.Event | None = None
+
+    def __call__(self, inputs: Mapping[str, torch.Tensor]) -> dict[str, torch.Tensor]:
+        if not self.device.startswith('cuda'):
+            return {key: value.to(self.device) for key, value in inputs.items()}
+
+        # the staging buffers are still read by the copies of the previous batch
+        if self._copy_done is not None:
+            self._copy_done.synchronize()
+        device_inputs = {}
+        for key, value in inputs.items():
+            buffers = self._buffers.get(key)
+            if buffers is None or buffers[0].dtype != value.dtype or buffers[0].numel() < value.numel():
+                buffers = (
+                    torch.empty(value.numel(), dtype=value.dtype, device=self.device),
+                    torch.empty(value.numel(), dtype=value.dtype, pin_memory=True),
+                )
+                self._buffers[key] = buffers
+            device_buffer, host_buffer = buffers
+            host_value = host_buffer[: value.numel()].view(value.shape)
+            host_value.copy_(value)
+            device_value = device_buffer[: value.numel()].view(value.shape)
+            device_value.copy_(host_value, non_blocking=True)
+            device_inputs[key] = device_value
+        self._copy_done = torch.cuda.Event()
+        self._copy_done.record(torch.cuda.current_stream(self.device))
+        return device_inputs
+
+
+def create_embeddings(client: Any, model_name: str, batch: list[str], max_retries: int = 5) -> np.ndarray:
+    for retry in range(max_retries):
+        try:
+            embeddings = client.create(input=batch, engine=model_name)['data']
+            break
+        except openai.error.RateLimitError as e:
+            if retry == max_retries - 1:
+                raise
+            retry_after = (e.headers or {}).get('Retry-After')
+            time.sleep(float(retry_after) if retry_after else 2**retry)
+    embeddings = sorted(embeddings, key=lambda e: e['index'])  # type: ignore
+    return np.array([result['embedding'] for result in embeddings], dtype=np.float32)
+
+
+def create_embeddings_concurrently(client: Any, model_name: str, batches: list[list[str]], num_workers: int = 4) -> np.ndarray:
+    all_embeddings = np.empty((sum(len(batch) for batch in batches), 0), dtype=np.float32)
+    offset = 0
+    with ThreadPoolExecutor(max_workers=num_workers) as executor:
+        results = executor.map(lambda batch: create_embeddings(client, model_name, batch), batches)
+        for embeddings in tqdm(results, total=len(batches)):
+            if offset == 0:
+                all_embeddings = np.empty((all_embeddings.shape[0], embeddings.shape[-1]), dtype=np.float32)
+            all_embeddings[offset : offset + len(embeddings)] = embeddings
+            offset += len(embeddings)
+    return all_embeddings
+
+
 class OpenAIModel:
-    def __init__(self, api_key: Optional[str] = None, model_name: str = 'text-embedding-ada-002') -> None:
+    def __init__(
+        self,
+        api_key: Optional[str] = None,
+        model_name: str = 'text-embedding-ada-002',
+        num_workers: int = 4,
+        max_batch_size: int = 2048,
+        max_tokens_per_request: int = 250_000,
+    ) -> None:
         if api_key is not None:
             openai.api_key = api_key
         self._client = openai.Embedding
         self.model_name = model_name
+        self.num_workers = num_workers
+        self.max_batch_size = max_batch_size
+        self.max_tokens_per_request = max_tokens_per_request
+        self._count_tokens = create_token_counter(model_name)
 
-    def encode(self, sentences: list[str], batch_size: int = 32, **kwargs) -> list[np.ndarray]:
-        all_embeddings = []
-        for batch in tqdm(generate_batch(sentences, batch_size), total=len(sentences) // batch_size):
-            embeddings = self._client.create(input=batch, engine=self.model_name)['data']   # type: ignore
-            embeddings = sorted(embeddings, key=lambda e: e['index'])  # type: ignore
-            embeddings = [np.array(result['embedding']) for result in embeddings]
-            all_embeddings.extend(embeddings)
-        return all_embeddings
+    def encode(self, sentences: list[str], batch_size: int = 32, **kwargs) -> np.ndarray:
+        # pack as many sentences per request as the API allows, batch_size is ignored
+        batches = list(
+            generate_text_batch(sentences, self.max_batch_size, self.max_tokens_per_request, self._count_tokens)
+        )
+        return create_embeddings_concurrently(self._client, self.model_name, batches, self.num_workers)
 
 
 class AzureModel:
-    def __init__(self, model_name: str = 'text-embedding-ada-002') -> None:
+    def __init__(
+        self,
+        model_name: str = 'text-embedding-ada-002',
+        max_chars_per_request: int = 2000,
+        num_workers: int = 4,
+        max_batch_size: int = 1,
+    ) -> None:
         openai.api_type = 'azure'
         openai.api_key = os.environ['AZURE_API_KEY']
         openai.api_base = os.environ['AZURE_API_BASE']
         openai.api_version = '2023-03-15-preview'
         self._client = openai.Embedding
         self.model_name = model_name
+        self.max_chars_per_request = max_chars_per_request
+        self.num_workers = num_workers
+        # the 2023-03-15-preview api accepts a single input per request for ada-002, newer versions accept 16
+        self.max_batch_size = max_batch_size
 
-    def encode(self, sentences: list[str], batch_size: int = 32, **kwargs) -> list[np.ndarray]:
-        all_embeddings = []
-        for text in tqdm(sentences):
-            embeddings = self._client.create(input=text, engine=self.model_name)['data']   # type: ignore
-            embeddings = [np.array(result['embedding']) for result in embeddings]
-            all_embeddings.extend(embeddings)
-            time.sleep(0.01)
-        return all_embeddings
+    def encode(self, sentences: list[str], batch_size: int = 32, **kwargs) -> np.ndarray:
+        batch_size = min(batch_size, self.max_batch_size)
+        batches = list(generate_text_batch(sentences, batch_size, self.max_chars_per_request))
+        return create_embeddings_concurrently(self._client, self.model_name, batches, self.num_workers)
 
 
 class ErLangShenModel:
-    def __init__(self, model_name: str = 'IDEA-CCNL/Erlangshen-SimCSE-110M-Chinese', device: str | None = None) -> None:
-        from transformers import AutoTokenizer, AutoModelForMaskedLM
+    def __init__(
+        self,
+        model_name: str = 'IDEA-CCNL/Erlangshen-SimCSE-110M-Chinese',
+        device: str | None = None,
+        compile_model: bool = True,
+        use_bettertransformer: bool = True,
+    ) -> None:
+        from transformers import AutoConfig, AutoTokenizer, AutoModel
 
         if device is None:
             self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
         else:
             self.device = device
-        self.model = AutoModelForMaskedLM.from_pretrained(model_name)
-        self.model.to(self.device)
+        # only the cls hidden state is used, so load the encoder without the mlm head and pooler where possible
+        config = AutoConfig.from_pretrained(model_name)
+        model_kwargs = {'add_pooling_layer': False} if config.model_type in POOLER_MODEL_TYPES else {}
+        self.model = AutoModel.from_pretrained(model_name, config=config, **model_kwargs)
+        self.model, self.num_devices, self.pad_to_multiple_of = prepare_encoder(
+            self.model, self.device, compile_model, use_bettertransformer
+        )
+        self._input_buffers = DeviceInputBuffers(self.device)
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
 
-    def encode(self, sentences: list[str], batch_size: int = 32, **kwargs) -> list[np.ndarray]:
-        all_embeddings: list[np.ndarray] = []
-        for batch_texts in tqdm(generate_batch(sentences, batch_size), total=len(sentences) // batch_size):
-            inputs = self.tokenizer(batch_texts, padding=True, truncation=True, return_tensors='pt', max_length=512)
-            inputs = inputs.to(self.device)
+    def encode(self, sentences: list[str], batch_size: int = 32, **kwargs) -> np.ndarray:
+        # sort by length so each batch is padded to similar lengths, then restore the original order
+        order = np.array(sorted(range(len(sentences)), key=lambda i: len(sentences[i])), dtype=np.int64)
+        sorted_sentences = [sentences[i] for i in order]
+        collector = EmbeddingCollector(order)
+        batch_size *= self.num_devices
+        for batch_texts in tqdm(generate_batch(sorted_sentences, batch_size), total=len(sentences) // batch_size):
+            inputs = self.tokenizer(
+                batch_texts,
+                padding=True,
+                truncation=True,
+                return_tensors='pt',
+                max_length=512,
+                pad_to_multiple_of=self.pad_to_multiple_of,
+            )
+            inputs = self._input_buffers(inputs)
             with torch.no_grad():
-                outputs = self.model(**inputs, output_hidden_states=True)
-                embeddings = outputs.hidden_states[-1][:, 0, :].squeeze()
+                outputs = self.model(**inputs)
+                embeddings = outputs.last_hidden_state[:, 0, :]
             embeddings = cast(torch.Tensor, embeddings)
-            all_embeddings.extend(embeddings.cpu().numpy())
-        return all_embeddings
+            collector.add(embeddings.detach())
+        return collector.finish()
 
 
 class LuotuoBertModel:
-    def __init__(self, model_name: str = 'silk-road/luotuo-bert', device: str | None = None) -> None:
+    def __init__(
+        self,
+        model_name: str = 'silk-road/luotuo-bert',
+        device: str | None = None,
+        compile_model: bool = True,
+        use_bettertransformer: bool = True,
+    ) -> None:
         from transformers import AutoTokenizer, AutoModel
         from argparse import Namespace
 
@@ -145,15 +384,29 @@ class LuotuoBertModel:
         self.tokenizer = AutoTokenizer.from_pretrained(model_name)
         model_args = Namespace(do_mlm=None, pooler_type='cls', temp=0.05, mlp_only_train=False, init_embeddings_model=None)
         self.model = AutoModel.from_pretrained(model_name, trust_remote_code=True, model_args=model_args)
-        self.model.to(device)
+        self.model, self.num_devices, self.pad_to_multiple_of = prepare_encoder(
+            self.model, self.device, compile_model, use_bettertransformer
+        )
+        self._input_buffers = DeviceInputBuffers(self.device)
 
-    def encode(self, sentences: list[str], batch_size: int = 32, **kwargs) -> list[np.ndarray]:
-        all_embeddings: list[np.ndarray] = []
-        for batch_texts in tqdm(generate_batch(sentences, batch_size), total=len(sentences) // batch_size):
-            inputs = self.tokenizer(batch_texts, padding=True, truncation=True, return_tensors='pt', max_length=512)
-            inputs = inputs.to(self.device)
+    def encode(self, sentences: list[str], batch_size: int = 32, **kwargs) -> np.ndarray:
+        # sort by length so each batch is padded to similar lengths, then restore the original order
+        order = np.array(sorted(range(len(sentences)), key=lambda i: len(sentences[i])), dtype=np.int64)
+        sorted_sentences = [sentences[i] for i in order]
+        collector = EmbeddingCollector(order)
+        batch_size *= self.num_devices
+        for batch_texts in tqdm(generate_batch(sorted_sentences, batch_size), total=len(sentences) // batch_size):
+            inputs = self.tokenizer(
+                batch_texts,
+                padding=True,
+                truncation=True,
+                return_tensors='pt',
+                max_length=512,
+                pad_to_multiple_of=self.pad_to_multiple_of,
+            )
+            inputs = self._input_buffers(inputs)
             with torch.no_grad():
                 embeddings = self.model(**inputs, output_hidden_states=True, return_dict=True, sent_emb=True).pooler_output
             embeddings = cast(torch.Tensor, embeddings)
-            all_embeddings.extend(embeddings.cpu().numpy())
-        return all_embeddings
+            collector.add(embeddings.detach())
+        return collector.finish()
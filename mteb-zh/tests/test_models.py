@@ -0,0 +1,95 @@
+from pathlib import Path
+
+import pytest
+import torch
+
+from mteb_zh.models import ErLangShenModel, create_token_counter, generate_text_batch
+
+FIXTURE_MODEL_DIR = Path(__file__).parents[2] / 'tests' / 'fixtures' / 'model'
+
+
+def test_generate_text_batch_cut_on_count():
+    batches = list(generate_text_batch(['a', 'b', 'c', 'd', 'e'], batch_size=2, max_length=100))
+
+    assert batches == [['a', 'b'], ['c', 'd'], ['e']]
+
+
+def test_generate_text_batch_cut_on_length():
+    batches = list(generate_text_batch(['aaaa', 'bbbb', 'cc', 'dddd'], batch_size=10, max_length=10))
+
+    assert batches == [['aaaa', 'bbbb', 'cc'], ['dddd']]
+
+
+def test_generate_text_batch_long_text_alone():
+    batches = list(generate_text_batch(['aa', 'b' * 20, 'cc'], batch_size=10, max_length=10))
+
+    assert batches == [['aa'], ['b' * 20], ['cc']]
+
+
+def test_create_token_counter_counts_special_token_text():
+    tiktoken = pytest.importorskip('tiktoken')
+    try:
+        tiktoken.encoding_for_model('text-embedding-ada-002')
+    except Exception:
+        pytest.skip('tiktoken encoding is not available')
+    count_tokens = create_token_counter('text-embedding-ada-002')
+
+    assert count_tokens('<|endoftext|>') > 1
+
+
+def test_erlangshen_model_uses_bettertransformer_fast_path(monkeypatch: pytest.MonkeyPatch):
+    pytest.importorskip('optimum.bettertransformer')
+    fused_layer_calls = 0
+    encoder_layer_fwd = torch._transformer_encoder_layer_fwd
+
+    def counting_encoder_layer_fwd(*args, **kwargs):
+        nonlocal fused_layer_calls
+        fused_layer_calls += 1
+        return encoder_layer_fwd(*args, **kwargs)
+
+    monkeypatch.setattr(torch, '_transformer_encoder_layer_fwd', counting_encoder_layer_fwd)
+    model = ErLangShenModel(model_name=str(FIXTURE_MODEL_DIR), device='cpu')
+    model.encode(['你好', '今天天气不错'], batch_size=2)
+
+    assert fused_layer_calls > 0
+
+
+def test_erlangshen_model_encode_matches_single_sentence_forward():
+    model = ErLangShenModel(model_name=str(FIXTURE_MODEL_DIR), device='cpu')
+    sentences = ['今天天气不错，适合出去走走', '你好', '这是一个稍微长一点的句子，用来测试填充', '好']
+
+    embeddings = model.encode(sentences, batch_size=2)
+
+    assert embeddings.shape[0] == len(sentences)
+    for sentence, embedding in zip(sentences, embeddings):
+        with torch.no_grad():
+            inputs = model.tokenizer([sentence], return_tensors='pt')
+            expected = model.model(**inputs).last_hidden_state[0, 0]
+        assert torch.allclose(torch.from_numpy(embedding), expected, atol=1e-4)
+
+
+def test_erlangshen_model_encode_single_sentence():
+    model = ErLangShenModel(model_name=str(FIXTURE_MODEL_DIR), device='cpu')
+
+    embeddings = model.encode(['你好'])
+
+    assert embeddings.shape == (1, model.model.config.hidden_size)
+
+
+def test_erlangshen_model_loads_encoder_without_pooler_option(tmp_path: Path):
+    from transformers import AutoTokenizer, DebertaV2Config, DebertaV2Model
+
+    config = DebertaV2Config(
+        vocab_size=AutoTokenizer.from_pretrained(FIXTURE_MODEL_DIR).vocab_size,
+        hidden_size=32,
+        num_hidden_layers=2,
+        num_attention_heads=2,
+        intermediate_size=64,
+    )
+    DebertaV2Model(config).save_pretrained(tmp_path)
+    AutoTokenizer.from_pretrained(FIXTURE_MODEL_DIR).save_pretrained(tmp_path)
+    model = ErLangShenModel(model_name=str(tmp_path), device='cpu')
+
+    embeddings = model.encode(['你好', '今天天气不错'])
+
+    assert embeddings.shape == (2, 32)
@@ -62,7 +62,8 @@ def main(
     save_on_epoch_end: Annotated[bool, typer.Option(rich_help_panel='Trainer')] = False,
     num_max_checkpoints: Annotated[int, typer.Option(rich_help_panel='Trainer')] = 1,
     use_tensorboard: Annotated[bool, typer.Option(rich_help_panel='Trainer')] = False,
-    num_workers: Annotated[int, typer.Option(rich_help_panel='Trainer')] = 0,
+    num_workers: Annotated[int, typer.Option(rich_help_panel='Trainer')] = 4,
+    prefetch_factor: Annotated[int, typer.Option(rich_help_panel='Trainer')] = 4,
     seed: Annotated[int, typer.Option(rich_help_panel='Trainer')] = 42,
     output_dir: Annotated[Optional[Path], typer.Option(rich_help_panel='Trainer')] = None,
 ):
@@ -96,8 +97,16 @@ def main(
         drop_last=drop_last,
     )
     data_collator = PairCollator(tokenizer=tokenizer, max_length=max_length)
+    # tokenization runs in the collator, so worker processes overlap it with the training step.
+    # workers are not persistent: the dataset is refreshed in the main process at the end of every epoch
     train_dataloader = DataLoader(
-        train_dataset, batch_size=None, collate_fn=data_collator, shuffle=True, num_workers=num_workers, pin_memory=True
+        train_dataset,
+        batch_size=None,
+        collate_fn=data_collator,
+        shuffle=True,
+        num_workers=num_workers,
+        pin_memory=True,
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
     )
     train_dataloader = accelerator.prepare(train_dataloader)
 
@@ -8,7 +8,7 @@ from accelerate.utils import ProjectConfiguration, set_seed
 from torch.utils.data import DataLoader
 from transformers import AutoTokenizer, get_cosine_schedule_with_warmup
 
-from uniem.data import MediDataset, PairCollator, TripletCollator
+from uniem.data import MediDataset, PairCollator, PreTokenizedPairCollator, PreTokenizedTripletCollator, TripletCollator
 from uniem.model import EmbedderForPairTrain, EmbedderForTrain, EmbedderForTripletTrain, EmbeddingStrategy, LossType
 from uniem.trainer import Trainer
 from uniem.types import MixedPrecisionType
@@ -33,6 +33,7 @@ def main(
     drop_last: Annotated[bool, typer.Option(rich_help_panel='Data')] = True,
     join_with: Annotated[str, typer.Option(rich_help_panel='Data')] = '\n',
     max_length: Annotated[int, typer.Option(rich_help_panel='Data')] = 512,
+    pre_tokenize: Annotated[bool, typer.Option(rich_help_panel='Data')] = True,
     # Optimizer
     lr: Annotated[float, typer.Option(rich_help_panel='Optimizer')] = 3e-5,
     weight_decay: Annotated[float, typer.Option(rich_help_panel='Optimizer')] = 1e-3,
@@ -44,7 +45,8 @@ def main(
     save_on_epoch_end: Annotated[bool, typer.Option(rich_help_panel='Trainer')] = False,
     num_max_checkpoints: Annotated[int, typer.Option(rich_help_panel='Trainer')] = 1,
     use_tensorboard: Annotated[bool, typer.Option(rich_help_panel='Trainer')] = False,
-    num_workers: Annotated[int, typer.Option(rich_help_panel='Trainer')] = 0,
+    num_workers: Annotated[int, typer.Option(rich_help_panel='Trainer')] = 4,
+    prefetch_factor: Annotated[int, typer.Option(rich_help_panel='Trainer')] = 4,
     seed: Annotated[int, typer.Option(rich_help_panel='Trainer')] = 42,
     output_dir: Annotated[Optional[Path], typer.Option(rich_help_panel='Trainer')] = None,
 ):
@@ -77,13 +79,28 @@ def main(
         with_prompt=with_prompt,
         join_with=join_with,
         drop_last=drop_last,
+        tokenizer=tokenizer if pre_tokenize else None,
+        max_length=max_length,
     )
-    if pair_or_triplet == 'triplet':
+    if pre_tokenize:
+        if pair_or_triplet == 'triplet':
+            data_collator = PreTokenizedTripletCollator(tokenizer=tokenizer)
+        else:
+            data_collator = PreTokenizedPairCollator(tokenizer=tokenizer)
+    elif pair_or_triplet == 'triplet':
         data_collator = TripletCollator(tokenizer=tokenizer, max_length=max_length)
     else:
         data_collator = PairCollator(tokenizer=tokenizer, max_length=max_length)
+    # collation runs in worker processes, overlapping it with the training step.
+    # workers are not persistent: the dataset is refreshed in the main process at the end of every epoch
     train_dataloader = DataLoader(
-        train_dataset, batch_size=None, collate_fn=data_collator, shuffle=True, num_workers=num_workers, pin_memory=True
+        train_dataset,
+        batch_size=None,
+        collate_fn=data_collator,
+        shuffle=True,
+        num_workers=num_workers,
+        pin_memory=True,
+        prefetch_factor=prefetch_factor if num_workers > 0 else None,
     )
     train_dataloader = accelerator.prepare(train_dataloader)
 
@@ -1,43 +1,108 @@
+import json
+
 import pytest
+import torch
 
 from tests import FIXTURES_DIR
-from uniem.data import MediDataset, TripletCollator
-from uniem.data_structures import TripletRecord
+from uniem.data import MediDataset, PreTokenizedTripletCollator, TripletCollator, random_indices
 
 
 def test_triplet_collator(tokenizer):
-    records = [
-        TripletRecord(
-            text='I like apples',
-            text_pos='I like oranges',
-            text_neg='I want to eat apples',
-        ),
-        TripletRecord(
-            text='I like football',
-            text_pos='I like basketball',
-            text_neg='I am a football player',
-        ),
-    ]
+    texts = ['I like apples', 'I like football']
+    texts_pos = ['I like oranges', 'I like basketball']
+    texts_neg = ['I want to eat apples', 'I am a football player']
     collator = TripletCollator(tokenizer, max_length=10)
 
-    batch = collator(records)
+    batch = collator((texts, texts_pos, texts_neg))
 
     assert set(batch.keys()) == {'text_ids', 'text_pos_ids', 'text_neg_ids'}
     assert batch['text_ids'].size(0) == 2
+    text_neg_ids = tokenizer(
+        texts_neg,
+        padding=True,
+        max_length=10,
+        truncation=True,
+        return_tensors='pt',
+    )['input_ids']
+    assert torch.equal(batch['text_neg_ids'], text_neg_ids)
 
 
 @pytest.mark.parametrize('batch_size', [4, 6, 8])
 def test_medi_dataset(batch_size: int):
     dataset = MediDataset(FIXTURES_DIR / 'mini_medi.json', batch_size=batch_size, join_with='\n')
 
+    for texts, texts_pos, texts_neg in dataset:
+        prompt = texts[0].split(dataset.join_with, 1)[0]
+        pos_prompt = texts_pos[0].split(dataset.join_with, 1)[0]
+        neg_prompt = texts_neg[0].split(dataset.join_with, 1)[0]
+        for text, text_pos, text_neg in zip(texts, texts_pos, texts_neg):
+            assert text.startswith(prompt)
+            assert text_pos.startswith(pos_prompt)
+            assert text_neg.startswith(neg_prompt)
+        assert len(set(texts)) != 1
+        assert len(set(texts_pos)) != 1
+        assert len(set(texts_neg)) != 1
+
+
+def test_pre_tokenized_medi_dataset(tokenizer):
+    torch.manual_seed(0)
+    text_dataset = MediDataset(FIXTURES_DIR / 'mini_medi.json', batch_size=4)
+    torch.manual_seed(0)
+    dataset = MediDataset(FIXTURES_DIR / 'mini_medi.json', batch_size=4, tokenizer=tokenizer, max_length=32)
+    collator = PreTokenizedTripletCollator(tokenizer)
+    text_collator = TripletCollator(tokenizer, max_length=32)
+
+    assert len(dataset) == len(text_dataset)
+    for records, text_records in zip(dataset, text_dataset):
+        batch = collator(records)
+        text_batch = text_collator(text_records)
+        for key in ('text_ids', 'text_pos_ids', 'text_neg_ids'):
+            assert torch.equal(batch[key], text_batch[key])
+
+
+def test_triplet_collator_left_padding(tokenizer):
+    tokenizer.padding_side = 'left'
+    texts = ['I like apples', 'I like to play football']
+    collator = TripletCollator(tokenizer, max_length=10)
+
+    batch = collator((texts, texts, texts))
+
+    text_ids = tokenizer(texts, padding=True, max_length=10, truncation=True, return_tensors='pt')['input_ids']
+    assert torch.equal(batch['text_ids'], text_ids)
+    assert batch['text_ids'][0, 0] == tokenizer.pad_token_id
+
+
+def test_pair_medi_dataset_without_neg(tmp_path):
+    medi_data = json.loads((FIXTURES_DIR / 'mini_medi.json').read_text())
+    for record in medi_data:
+        del record['neg']
+    medi_data_file = tmp_path / 'pair_medi.json'
+    medi_data_file.write_text(json.dumps(medi_data))
+
+    dataset = MediDataset(medi_data_file, batch_size=4, pair_or_triplet='pair')
+
     for records in dataset:
-        prompt = records[0].text.split(dataset.join_with, 1)[0]
-        pos_prompt = records[0].text_pos.split(dataset.join_with, 1)[0]
-        neg_prompt = records[0].text_neg.split(dataset.join_with, 1)[0]
-        for record in records:
-            assert record.text.startswith(prompt)
-            assert record.text_pos.startswith(pos_prompt)
-            assert record.text_neg.startswith(neg_prompt)
-        assert len(set(record.text for record in records)) != 1
-        assert len(set(record.text_pos for record in records)) != 1
-        assert len(set(record.text_neg for record in records)) != 1
+        assert len(records) == 2
+
+
+@pytest.mark.parametrize('num_items, num_samples', [(5, 3), (5, 5), (5, 12), (3, 9)])
+def test_random_indices(num_items: int, num_samples: int):
+    indices = random_indices(num_items, num_samples)
+
+    assert len(indices) == num_samples
+    for start in range(0, num_samples - num_items + 1, num_items):
+        assert sorted(indices[start : start + num_items].tolist()) == list(range(num_items))
+    assert len(set(indices[num_samples - num_samples % num_items :].tolist())) == num_samples % num_items
+
+
+def test_random_indices_empty():
+    assert len(random_indices(0, 4)) == 0
+    assert len(random_indices(4, 0)) == 0
+
+
+@pytest.mark.parametrize('batch_size', [3, 5, 7])
+def test_medi_dataset_without_drop_last(batch_size: int):
+    dataset = MediDataset(FIXTURES_DIR / 'mini_medi.json', batch_size=batch_size, drop_last=False)
+
+    for texts, texts_pos, texts_neg in dataset:
+        assert len(texts) == len(texts_pos) == len(texts_neg) == batch_size
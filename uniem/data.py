@@ -4,41 +4,53 @@ from dataclasses import dataclass
 from pathlib import Path
 from typing import Any, cast
 
+import numpy as np
 import torch
-from torch.utils.data import Dataset, RandomSampler
+from torch.utils.data import Dataset
 
 from datasets import Dataset as HfDataset
-from uniem.data_structures import PairRecord, TripletRecord
 from uniem.types import Tokenizer
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def random_indices(num_items: int, num_samples: int) -> torch.Tensor:
+    # same as RandomSampler(num_samples=num_samples): chained permutations, the last one truncated
+    if num_items == 0 or num_samples == 0:
+        return torch.empty(0, dtype=torch.long)
+    num_permutations = -(-num_samples // num_items)
+    return torch.cat([torch.randperm(num_items) for _ in range(num_permutations)])[:num_samples]
+
+
+def tokenize_text_groups(tokenizer: Tokenizer, text_groups: list[list[str]], max_length: int) -> list[torch.Tensor]:
+    # tokenize every group with a single tokenizer call, then pad each group to its own max length
+    all_texts = [text for texts in text_groups for text in texts]
+    all_input_ids = tokenizer(all_texts, max_length=max_length, truncation=True)['input_ids']
+    all_input_ids = cast(list[list[int]], all_input_ids)
+
+    group_ids_list = []
+    start = 0
+    for texts in text_groups:
+        input_ids = all_input_ids[start : start + len(texts)]
+        # tokenizer.pad respects padding_side and runs in python, without another call into the tokenizer backend
+        group_ids = tokenizer.pad({'input_ids': input_ids}, return_tensors='pt')['input_ids']
+        group_ids_list.append(cast(torch.Tensor, group_ids))
+        start += len(texts)
+    return group_ids_list
+
 
 class PairCollator:
     def __init__(self, tokenizer: Tokenizer, max_length: int | None = None) -> None:
         self.tokenizer = tokenizer
         self.max_length = max_length or tokenizer.model_max_length
 
-    def __call__(self, records: list[PairRecord]) -> dict[str, torch.Tensor]:
-        texts = [record.text for record in records]
-        texts_pos = [record.text_pos for record in records]
-
-        text_ids = self.tokenizer(
-            texts,
-            padding=True,
-            max_length=self.max_length,
-            truncation=True,
-            return_tensors='pt',
-        )['input_ids']
-        text_ids = cast(torch.Tensor, text_ids)
-
-        text_pos_ids = self.tokenizer(
-            texts_pos,
-            padding=True,
-            max_length=self.max_length,
-            truncation=True,
-            return_tensors='pt',
-        )['input_ids']
-        text_pos_ids = cast(torch.Tensor, text_pos_ids)
+    def __call__(self, records: tuple[list[str], list[str]]) -> dict[str, torch.Tensor]:
+        texts, texts_pos = records
 
+        text_ids, text_pos_ids = tokenize_text_groups(self.tokenizer, [texts, texts_pos], self.max_length)
         return {
             'text_ids': text_ids,
             'text_pos_ids': text_pos_ids,
@@ -50,36 +62,12 @@ class TripletCollator:
         self.tokenizer = tokenizer
         self.max_length = max_length or tokenizer.model_max_length
 
-    def __call__(self, records: list[TripletRecord]) -> dict[str, torch.Tensor]:
-        texts = [record.text for record in records]
-        texts_pos = [record.text_pos for record in records]
-        texts_neg = [record.text_neg for record in records]
-
-        text_ids = self.tokenizer(
-            texts,
-            padding=True,
-            max_length=self.max_length,
-            truncation=True,
-            return_tensors='pt',
-        )['input_ids']
-        text_pos_ids = self.tokenizer(
-            texts_pos,
-            padding=True,
-            max_length=self.max_length,
-            truncation=True,
-            return_tensors='pt',
-        )['input_ids']
-        text_neg_ids = self.tokenizer(
-            texts_neg,
-            padding=True,
-            max_length=self.max_length,
-            truncation=True,
-            return_tensors='pt',
-        )['input_ids']
-
-        text_ids = cast(torch.Tensor, text_ids)
-        text_pos_ids = cast(torch.Tensor, text_pos_ids)
-        text_neg_ids = cast(torch.Tensor, text_neg_ids)
+    def __call__(self, records: tuple[list[str], list[str], list[str]]) -> dict[str, torch.Tensor]:
+        texts, texts_pos, texts_neg = records
+
+        text_ids, text_pos_ids, text_neg_ids = tokenize_text_groups(
+            self.tokenizer, [texts, texts_pos, texts_neg], self.max_length
+        )
         return {
             'text_ids': text_ids,
             'text_pos_ids': text_pos_ids,
@@ -87,6 +75,36 @@ class TripletCollator:
         }
 
 
+def pad_token_ids(tokenizer: Tokenizer, token_ids_list: list[np.ndarray]) -> torch.Tensor:
+    token_ids = tokenizer.pad({'input_ids': token_ids_list}, return_tensors='pt')['input_ids']
+    return cast(torch.Tensor, token_ids)
+
+
+class PreTokenizedPairCollator:
+    def __init__(self, tokenizer: Tokenizer) -> None:
+        self.tokenizer = tokenizer
+
+    def __call__(self, records: tuple[list[np.ndarray], list[np.ndarray]]) -> dict[str, torch.Tensor]:
+        text_ids, text_pos_ids = records
+        return {
+            'text_ids': pad_token_ids(self.tokenizer, text_ids),
+            'text_pos_ids': pad_token_ids(self.tokenizer, text_pos_ids),
+        }
+
+
+class PreTokenizedTripletCollator:
+    def __init__(self, tokenizer: Tokenizer) -> None:
+        self.tokenizer = tokenizer
+
+    def __call__(self, records: tuple[list[np.ndarray], list[np.ndarray], list[np.ndarray]]) -> dict[str, torch.Tensor]:
+        text_ids, text_pos_ids, text_neg_ids = records
+        return {
+            'text_ids': pad_token_ids(self.tokenizer, text_ids),
+            'text_pos_ids': pad_token_ids(self.tokenizer, text_pos_ids),
+            'text_neg_ids': pad_token_ids(self.tokenizer, text_neg_ids),
+        }
+
+
 class MediDataset(Dataset):
     def __init__(
         self,
@@ -96,66 +114,75 @@ class MediDataset(Dataset):
         with_prompt: bool = True,
         join_with: str = '\n',
         drop_last: bool = True,
+        tokenizer: Tokenizer | None = None,
+        max_length: int | None = None,
     ):
-        medi_data = json.load(fp=Path(medi_data_file).open())
+        if orjson is not None:
+            medi_data = orjson.loads(Path(medi_data_file).read_bytes())
+        else:
+            medi_data = json.loads(Path(medi_data_file).read_text())
         self.batch_size = batch_size
         self.join_with = join_with
         self.drop_last = drop_last
         assert pair_or_triplet in ('pair', 'triplet')
+        self.pair_or_triplet = pair_or_triplet
 
-        self._task_records_map: dict[str, list[TripletRecord | PairRecord]] = defaultdict(list)
+        # one column per field, each holding str (or token ids after pre-tokenization)
+        self._task_texts_map: dict[str, list[Any]] = defaultdict(list)
+        self._task_pos_map: dict[str, list[Any]] = defaultdict(list)
+        self._task_neg_map: dict[str, list[Any]] = defaultdict(list)
         for record in medi_data:
             taks_name = record['task_name']
             if with_prompt:
-                if pair_or_triplet == 'triplet':
-                    record = TripletRecord(
-                        text=join_with.join(record['query']),
-                        text_pos=join_with.join(record['pos']),
-                        text_neg=join_with.join(record['neg']),
-                    )
-                else:
-                    record = PairRecord(
-                        text=join_with.join(record['query']),
-                        text_pos=join_with.join(record['pos']),
-                    )
+                self._task_texts_map[taks_name].append(join_with.join(record['query']))
+                self._task_pos_map[taks_name].append(join_with.join(record['pos']))
             else:
-                if pair_or_triplet == 'triplet':
-                    record = TripletRecord(
-                        text=record['query'][1],
-                        text_pos=record['pos'][1],
-                        text_neg=record['neg'][1],
-                    )
-                else:
-                    record = PairRecord(
-                        text=record['query'][1],
-                        text_pos=record['pos'][1],
-                    )
-            self._task_records_map[taks_name].append(record)
+                self._task_texts_map[taks_name].append(record['query'][1])
+                self._task_pos_map[taks_name].append(record['pos'][1])
+            # pair-format files may have no neg field at all
+            if pair_or_triplet == 'triplet':
+                text_neg = join_with.join(record['neg']) if with_prompt else record['neg'][1]
+                self._task_neg_map[taks_name].append(text_neg)
+
+        # tokenize once here, so collators only need to pad on every epoch
+        if tokenizer is not None:
+            max_length = max_length or tokenizer.model_max_length
+            for task_map in (self._task_texts_map, self._task_pos_map, self._task_neg_map):
+                for task_name, texts in task_map.items():
+                    task_map[task_name] = self.tokenize_texts(texts, tokenizer, max_length)
         self.create_or_refresh_data()
 
+    @staticmethod
+    def tokenize_texts(texts: list[str], tokenizer: Tokenizer, max_length: int) -> list[np.ndarray]:
+        input_ids = tokenizer(texts, max_length=max_length, truncation=True)['input_ids']
+        return [np.array(ids, dtype=np.int32) for ids in cast(list[list[int]], input_ids)]
+
+    def _task_columns(self, task_name: str) -> list[list[Any]]:
+        columns = [self._task_texts_map[task_name], self._task_pos_map[task_name]]
+        if self.pair_or_triplet == 'triplet':
+            columns.append(self._task_neg_map[task_name])
+        return columns
+
     def create_or_refresh_data(self):
         batch_size = self.batch_size
         self.batched_records = []
-        for _, records in self._task_records_map.items():
-            buffer = []
+        for task_name, texts in self._task_texts_map.items():
+            columns = self._task_columns(task_name)
 
-            num_samples = (len(records) // batch_size) * batch_size
-            if not self.drop_last and len(records) % batch_size != 0:
+            num_samples = (len(texts) // batch_size) * batch_size
+            if not self.drop_last and len(texts) % batch_size != 0:
                 num_samples += batch_size
 
             if not num_samples:
-                self.batched_records.append(records)
+                self.batched_records.append(tuple(columns))
                 continue
 
-            for i in RandomSampler(records, num_samples=num_samples):
-                buffer.append(records[i])
-                if len(buffer) == batch_size:
-                    self.batched_records.append(buffer)
-                    buffer = []
-        self.random_index_list = list(RandomSampler(self.batched_records))
+            for batch_index in random_indices(len(texts), num_samples).view(-1, batch_size).tolist():
+                self.batched_records.append(tuple([column[i] for i in batch_index] for column in columns))
+        # shuffle once here, so __getitem__ is a single lookup
+        self.batched_records = [self.batched_records[i] for i in torch.randperm(len(self.batched_records)).tolist()]
 
     def __getitem__(self, index):
-        index = self.random_index_list[index]
         return self.batched_records[index]
 
     def __len__(self):
@@ -205,22 +232,22 @@ class M3EDataset(Dataset):
         for dataset in self.m3e_hf_datasets:
             max_samples = self.max_samples or len(dataset.hf_dataset)
             num_samples = (max_samples // self.batch_size) * self.batch_size
-            buffer = []
-            for i in RandomSampler(dataset.hf_dataset, num_samples=num_samples):
-                buffer.append(i)
-                if len(buffer) == self.batch_size:
-                    self.task_batch_index_list.append(TaskBatchIndex(name=dataset.name, batch_index=buffer))
-                    buffer = []
-        self.random_index_list = list(RandomSampler(self.task_batch_index_list))
+            batch_indices = random_indices(len(dataset.hf_dataset), num_samples).view(-1, self.batch_size).tolist()
+            self.task_batch_index_list.extend(
+                TaskBatchIndex(name=dataset.name, batch_index=batch_index) for batch_index in batch_indices
+            )
+        self.task_batch_index_list = [
+            self.task_batch_index_list[i] for i in torch.randperm(len(self.task_batch_index_list)).tolist()
+        ]
 
     def __getitem__(self, index: int):
-        index = self.random_index_list[index]
         task_batch_index = self.task_batch_index_list[index]
         task_name = task_batch_index.name
         batch_index = task_batch_index.batch_index
         hf_dataset = self.name_dataset_map[task_name]
         records = [hf_dataset[i] for i in batch_index]
-        pair_records = []
+        texts = []
+        texts_pos = []
         for record in records:
             text = record['text']
             text_pos = record['text_pos']
@@ -228,10 +255,11 @@ class M3EDataset(Dataset):
                 continue
             if self.task_instruction_map is not None:
                 text = self.task_instruction_map[task_name] + text
-            pair_records.append(PairRecord(text=text, text_pos=text_pos))
-        if not pair_records:
+            texts.append(text)
+            texts_pos.append(text_pos)
+        if not texts:
             raise ValueError(f'records is empty, {records}')
-        return pair_records
+        return texts, texts_pos
 
     def __len__(self):
         return len(self.task_batch_index_list)